@@ -1,10 +1,59 @@
 
-import serial
+import os
+import re
 import time
+import json
 import struct
 import math
+import bisect
+import threading
+from ValonTransport import OpenTransport
 
 RECV_LEN = 1024
+# on-disk cache of the V500X state, see V500X.LoadState
+# one file per device, so that processes using different devices don't
+# overwrite each other
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyvalon', 'state')
+STATE_VERSION = 1
+# settle time tables, see V500X.CharacterizeSettle
+SETTLE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyvalon', 'settle')
+# V5015 ends every reply with this prompt
+PROMPT = '-->'
+
+def _cache_name(device):
+    """
+    Description:
+        Turn a device identity into a file name for the caches.
+    """
+    return re.sub(r'[^\w.-]', '_', device)
+
+class ValonError(Exception):
+    """
+    Description:
+        Base class for the errors reported by the valon devices.
+    """
+    pass
+
+class ValonTimeout(ValonError):
+    """
+    Description:
+        The device didn't reply, or the reply is shorter than expected.
+    """
+    pass
+
+class ValonChecksumError(ValonError):
+    """
+    Description:
+        The checksum of the read back data is incorrect.
+    """
+    pass
+
+class ValonNack(ValonError):
+    """
+    Description:
+        The device replied NACK to a command.
+    """
+    pass
 
 class Valon(object):
     """
@@ -13,15 +62,56 @@ class Valon(object):
         which uses serial port.
     """
     def __init__(self, dev, baud):
-        self.ser = serial.Serial(dev,baud,timeout=0.5, rtscts=False, xonxoff=False)
+        """
+        Inputs:
+            - dev (str): serial port, 'socket://host:port' for a TCP serial
+              server, or 'loop://', see ValonTransport.OpenTransport.
+            - baud (int): baud rate.
+        """
+        self.ser = OpenTransport(dev, baud, timeout=0.5)
     
+    def _readreplies(self, n):
+        """
+        Description:
+            Read until n prompts have been received, or the device goes quiet
+            for a whole timeout.
+        Inputs:
+            - n (int): the number of replies expected.
+        Outputs:
+            - r (bytes): the raw replies.
+        """
+        r = b''
+        while r.count(PROMPT.encode()) < n and len(r) < n * RECV_LEN:
+            d = self.ser.read(max(1, self.ser.in_waiting))
+            if len(d) == 0:
+                break
+            r += d
+        return r
+
+    def _splitreplies(self, r):
+        """
+        Description:
+            Split the raw replies into one string per command.
+        Inputs:
+            - r (bytes or str): the raw replies.
+        Outputs:
+            - rs (list): the complete replies, each one ends with the prompt.
+        """
+        if isinstance(r, bytes):
+            r = r.decode()
+        rs = r.split(PROMPT)
+        # whatever follows the last prompt is an incomplete reply, so it's
+        # dropped rather than parsed
+        rs.pop()
+        return [x + PROMPT for x in rs]
+
     def sendcmd(self, cmd):
         try:
             self.ser.write(cmd.encode('utf-8'))
-            r = self.ser.read(RECV_LEN).decode()
+            r = self._readreplies(1).decode()
         except:
             self.ser.write(cmd)
-            r = self.ser.read(RECV_LEN)
+            r = self._readreplies(1)
         return r
 
     def close(self):
@@ -33,6 +123,31 @@ class V5015(Valon):
         This class is based on Valon class, 
         and is especially for V5015
     """
+    # frequency units, in MHz
+    FREQ_UNIT = {
+        'HZ': 1e-6,
+        'KHZ': 1e-3,
+        'MHZ': 1.0,
+        'GHZ': 1e3
+    }
+    def _freq_cmd(self, f=-1, u='MHz'):
+        if f == -1:
+            return 'F\r'
+        if u == 'MHz' and f > 15000:
+            f = 15000
+            print('The max freq is 15000MHz.')
+        elif u == 'GHz' and f > 15:
+            f = 15
+            print('The max freq is 15GHz.')
+        return 'F ' + str(f) + ' ' + u + '\r'
+
+    def _freq_reply(self, r, query):
+        if query:
+            rs = r.split(';')[0].split(' ')
+        else:
+            rs = r.split('\r')[0].split(' ')
+        return rs[1]+rs[2]
+
     def SetFreq(self, f=-1, u='MHz', verbose=False):
         """
         Set Frequency.
@@ -45,25 +160,27 @@ class V5015(Valon):
         Ouputs:
             - r (str): the frequency been set
         """
-        if f == -1:
-            cmd = 'F\r'
-        else:
-            if u == 'MHz' and f > 15000:
-                f = 15000
-                print('The max freq is 15000MHz.')
-            elif u == 'GHz' and f > 15:
-                f = 15
-                print('The max freq is 15GHz.')
-            cmd = 'F ' + str(f) + ' ' + u + '\r'
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._freq_cmd(f, u))
         if verbose:
             print(r)
-        if f == -1:
-            rs = r.split(';')[0].split(' ')
-        else:
-            rs = r.split('\r')[0].split(' ')
-        return rs[1]+rs[2]
+        return self._freq_reply(r, f == -1)
     
+    def _amp_cmd(self, a=100):
+        if a == 100:
+            return 'PWR\r'
+        if a > 14:
+            a = 14
+            print('The max amplitude is 14dBm.')
+        return 'PWR ' + str(a) + '\r'
+
+    def _amp_reply(self, r, query):
+        rs0 = r.split(';')[0].split(' ')
+        rs1 = r.split(';')[1].split(' ')[3].split('\r')
+        if query:
+            return rs0[1]+rs1[0]
+        else:
+            return rs0[2]+rs1[0]
+
     def SetAmp(self, a=100, verbose=False):
         """
         Set Amplitude in dBm.
@@ -75,25 +192,36 @@ class V5015(Valon):
         Ouputs:
             - r (str): the amplitude been set
         """
-        if a == 100:
-            cmd = 'PWR\r'
-        else:
-            if a > 14:
-                a = 14
-                print('The max amplitude is 14dBm.')
-            cmd = 'PWR ' + str(a) + '\r' 
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._amp_cmd(a))
         if verbose:
             print(r)
-        
-        rs0 = r.split(';')[0].split(' ')
-        rs1 = r.split(';')[1].split(' ')[3].split('\r')
-        if a == 100:
-            return rs0[1]+rs1[0]
-        else:
-            return rs0[2]+rs1[0]
-        
+        return self._amp_reply(r, a == 100)
     
+    def _refs_cmd(self, s=''):
+        if s == 'internal':
+            src = str(0)
+        elif s == 'external':
+            src = str(1)
+        else:
+            src = ''
+        return 'REFS ' + src + '\r'
+
+    def _refs_reply(self, r):
+        rs = r.split(';')[0].split(' ')
+        if rs[2] == '0':
+            return 'internal'
+        elif rs[2] == '1':
+            return 'external'
+        return ''
+
+    def _ref_cmd(self, f=10):
+        return 'REF ' + str(f) + ' ' + 'MHz\r'
+
+    def _ref_reply(self, r):
+        rs1 = r.split(';')[0].split(' ')
+        rs2 = r.split(';')[0].split(' ')[2].split('\r')
+        return rs1[1] + rs2[0]
+
     def SetRef(self, s='', f=10, verbose=False):
         """
         Set Ref and Ref source in MHz 
@@ -108,33 +236,34 @@ class V5015(Valon):
         Outputs:
             - r (str): ref source and ref frequency in MHz
         """
-        if s == 'internal':
-            src = str(0)
-        elif s == 'external':
-            src = str(1)
-        else:
-            src = ''
         # set refernce source first
-        cmd = 'REFS ' + src + '\r'
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._refs_cmd(s))
         if verbose:
             print(r)
-        rs = r.split(';')[0].split(' ')
-        ref_src=''
-        if rs[2] == '0':
-            ref_src += 'internal'
-        elif rs[2] == '1':
-            ref_src += 'external'
+        ref_src = self._refs_reply(r)
         # ser reference frequency in MHz
-        cmd = 'REF ' + str(f) + ' ' + 'MHz\r'
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._ref_cmd(f))
         if verbose:
             print(r)
-        rs1 = r.split(';')[0].split(' ')
-        rs2 = r.split(';')[0].split(' ')[2].split('\r')
-        ref_val = rs1[1] + rs2[0]
+        ref_val = self._ref_reply(r)
         return ref_src + ' ' + ref_val
     
+    def _onoff_cmd(self, name, s=''):
+        if len(s) == 0:
+            return name + '\r'
+        return name + ' ' + s.upper() + '\r'
+
+    def _onoff_reply(self, r, query):
+        if query:
+            index = 1
+        else:
+            index = 2
+        rs = r.split(';')[0].split(' ')
+        if rs[index] == '0':
+            return 'OFF'
+        elif rs[index] == '1':
+            return 'ON'
+
     def RFout(self, s='', verbose=False):
         """
         Turn on/off the RFout.
@@ -146,20 +275,10 @@ class V5015(Valon):
         Outputs:
             - r (str): RFout status
         """
-        if len(s) == 0:
-            cmd = 'OEN\r'
-            index = 1
-        else:
-            cmd = 'OEN ' + s.upper() + '\r'
-            index = 2
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._onoff_cmd('OEN', s))
         if verbose:
             print(r)
-        rs = r.split(';')[0].split(' ')
-        if rs[index] == '0':
-            return 'OFF'
-        elif rs[index] == '1':
-            return 'ON'
+        return self._onoff_reply(r, len(s) == 0)
     
     def PWRout(self, s='', verbose=False):
         """
@@ -172,20 +291,173 @@ class V5015(Valon):
         Ouputs:
             - r(str): Power status
         """
-        if len(s) == 0:
-            cmd = 'PDN\r'
-            index = 1
-        else:
-           cmd = 'PDN ' + s.upper() + '\r' 
-           index = 2
-        r = self.sendcmd(cmd)
+        r = self.sendcmd(self._onoff_cmd('PDN', s))
         if verbose:
             print(r)
-        rs = r.split(';')[0].split(' ')
-        if rs[index] == '0':
-            return 'OFF'
-        elif rs[index] == '1':
-            return 'ON'
+        return self._onoff_reply(r, len(s) == 0)
+
+    def Apply(self, freq=None, amp=None, ref=None, ref_freq=10, rfout=None, pwr=None, verbose=False):
+        """
+        Apply several settings in one round trip.
+        All the commands are sent in one burst, then all the replies
+        are read back in one pass and parsed one by one.
+
+        Inputs:
+            - freq (float): frequency in MHz.
+            - amp (float): amplitude in dBm.
+            - ref (str): reference source('internal', 'external' or 'status').
+            - ref_freq (int): reference frequency in MHz, used with ref.
+                Default=10
+            - rfout (str): RFout status('on', 'off' or 'status').
+            - pwr (str): Power status('on', 'off' or 'status').
+            - verbose (bool): be verbose
+                Default=False
+            The settings left as None are not touched.
+        Outputs:
+            - r (dict): the same results as SetFreq, SetAmp, SetRef, RFout
+              and PWRout, keyed by 'freq', 'amp', 'ref', 'rfout' and 'pwr'.
+              A setting without a valid reply is None.
+        """
+        # (key, command, reply parser)
+        cmds = []
+        if freq is not None:
+            cmds.append(('freq', self._freq_cmd(freq, 'MHz'), lambda r: self._freq_reply(r, freq == -1)))
+        if amp is not None:
+            cmds.append(('amp', self._amp_cmd(amp), lambda r: self._amp_reply(r, amp == 100)))
+        if ref is not None:
+            src = '' if ref == 'status' else ref
+            cmds.append(('refs', self._refs_cmd(src), self._refs_reply))
+            cmds.append(('ref', self._ref_cmd(ref_freq), self._ref_reply))
+        if rfout is not None:
+            s = '' if rfout == 'status' else rfout
+            cmds.append(('rfout', self._onoff_cmd('OEN', s), lambda r: self._onoff_reply(r, s == '')))
+        if pwr is not None:
+            p = '' if pwr == 'status' else pwr
+            cmds.append(('pwr', self._onoff_cmd('PDN', p), lambda r: self._onoff_reply(r, p == '')))
+        if len(cmds) == 0:
+            return {}
+        # drop the leftover of an earlier command, so the replies line up
+        self.ser.reset_input_buffer()
+        self.ser.write(''.join([c[1] for c in cmds]).encode('utf-8'))
+        rs = self._splitreplies(self._readreplies(len(cmds)))
+        if len(rs) < len(cmds):
+            # the late replies would be taken for the next command's
+            self.ser.reset_input_buffer()
+        if verbose:
+            for r in rs:
+                print(r)
+        res = {}
+        for i in range(len(cmds)):
+            key, cmd, parse = cmds[i]
+            try:
+                res[key] = parse(rs[i])
+            except:
+                print('No valid reply for %s'%cmd.strip())
+                res[key] = None
+        if 'ref' in res:
+            ref_src = res.pop('refs')
+            if ref_src is None or res['ref'] is None:
+                res['ref'] = None
+            else:
+                res['ref'] = ref_src + ' ' + res['ref']
+        return res
+
+    def _freq_achieved(self, r):
+        """
+        Description:
+            Get the actual frequency from a reply to 'F <f> MHz'.
+        Outputs:
+            - f (float): the actual frequency in MHz, None if the reply has
+              no 'Act' field, as the requested frequency echoed back doesn't
+              tell what the device has set.
+        """
+        m = re.search(r'Act\s+([-+]?[.\d]+(?:[eE][-+]?\d+)?)\s*([kKmMgG]?[hH][zZ])?', r)
+        if m is None:
+            return None
+        f = float(m.group(1))
+        if m.group(2) is not None:
+            f *= V5015.FREQ_UNIT[m.group(2).upper()]
+        return f
+
+    def Sweep(self, freqs, window=4, tol=0.001, verbose=False):
+        """
+        Sweep the frequency as fast as the device accepts it.
+        All the commands are formatted in advance, and up to window
+        commands are in flight at a time: a new one is sent each time a
+        reply comes back.
+
+        Inputs:
+            - freqs (list): frequencies in MHz.
+            - window (int): max number of commands in flight, at least 1.
+                Default=4
+            - tol (float): max difference in MHz between the requested and
+              the actual frequency.
+                Default=0.001
+            - verbose (bool): be verbose
+                Default=False
+        Outputs:
+            - r (dict):
+                'achieved': the actual frequency of each point in MHz, None
+                    if no valid reply, or if the reply has no actual frequency,
+                'errors': the indices of the points without a verified
+                    frequency, or out of tol,
+                'points': the number of points set correctly,
+                'time': the time of the sweep in seconds,
+                'rate': points per second.
+        """
+        if window < 1:
+            raise ValueError('The window must be at least 1, while it is %s.'%window)
+        if len(freqs) > 0 and max(freqs) > 15000:
+            print('The max freq is 15000MHz.')
+        freqs = [min(f, 15000) for f in freqs]
+        cmds = [('F ' + str(f) + ' MHz\r').encode('utf-8') for f in freqs]
+        achieved = [None] * len(freqs)
+        prompt = PROMPT.encode()
+        buf = b''
+        sent = 0
+        done = 0
+        t0 = time.time()
+        # drop the leftover of an earlier command, so the replies line up
+        self.ser.reset_input_buffer()
+        self.ser.write(b''.join(cmds[:window]))
+        sent = min(window, len(cmds))
+        while done < sent:
+            d = self.ser.read(max(1, self.ser.in_waiting))
+            if len(d) == 0:
+                # the device has gone quiet, the rest is lost, and the late
+                # replies would be taken for the next command's
+                self.ser.reset_input_buffer()
+                break
+            buf += d
+            replies = buf.split(prompt)
+            buf = replies.pop()
+            for r in replies:
+                r = r.decode()
+                if verbose:
+                    print(r)
+                try:
+                    achieved[done] = self._freq_achieved(r)
+                except (ValueError, IndexError):
+                    pass
+                done += 1
+            # keep the window full
+            n = min(len(cmds), done + window) - sent
+            if n > 0:
+                self.ser.write(b''.join(cmds[sent:sent+n]))
+                sent += n
+        t = time.time() - t0
+        errors = []
+        for i in range(len(freqs)):
+            if achieved[i] is None or abs(achieved[i] - freqs[i]) > tol:
+                errors.append(i)
+        points = len(freqs) - len(errors)
+        return {
+            'achieved': achieved,
+            'errors': errors,
+            'points': points,
+            'time': t,
+            'rate': points / t if t > 0 else 0.0
+        }
 
       
 class V500X(object):
@@ -202,16 +474,303 @@ class V500X(object):
         'ACK': 0x06,
         'NACK': 0x15
     }
-    def __init__(self, dev, baud=9600):
-        self.ser = serial.Serial(dev,baud,timeout=0.5, rtscts=False, xonxoff=False)
+    def __init__(self, dev, baud=9600, retries=3, backoff=0.05, cache=None):
+        """
+        Inputs:
+            - dev (str): serial port, 'socket://host:port' for a TCP serial
+              server, or 'loop://', see ValonTransport.OpenTransport.
+            - baud (int): baud rate.
+                Default=9600
+            - retries (int): how many times a read is retried after an error.
+                Default=3
+            - backoff (float): delay in seconds before the first retry,
+              doubled for each following retry.
+                Default=0.05
+            - cache (str): the state cache directory, True for STATE_DIR.
+              The state is loaded when the device is opened, and saved when
+              it is closed.
+                Default=None, no state cache
+        """
+        self.ser = OpenTransport(dev, baud, timeout=0.5)
+        self.retries = retries
+        self.backoff = backoff
+        # one transaction at a time, as the auto commit runs in a timer thread
+        self.lock = threading.RLock()
+        # the last known state of the device, so that the static information
+        # is not read back again before every calculation
+        self.shadow = {'reference': None, 'vcor': {}, 'regs': {}, 'refsel': None}
+        # the state at the last flash, and what has been written since then
+        # while the state at the last flash is unknown
+        self.flashed = {'known': False, 'regs': {}, 'refsel': None}
+        self.unflashed = set()
+        self.commit_delay = None
+        self.commit_timer = None
+        if cache == True:
+            cache = STATE_DIR
+        self.cache = cache
+        if self.cache:
+            try:
+                self.LoadState(self._state_path(self.cache))
+            except Exception:
+                self.ser.close()
+                raise
     
     def _write(self, cmd):
         self.ser.write(cmd)
     
     def _read(self, l):
         return self.ser.read(l)
-    
+
+    def _resync(self):
+        """
+        Description:
+            Drop whatever is left in the input buffer, so that the leftover
+            bytes of a broken transaction don't corrupt the next one.
+        """
+        self.ser.reset_input_buffer()
+
+    def _query(self, cmd, l):
+        """
+        Description:
+            Send a read command, and read back the data and its checksum.
+            Reads are idempotent, so they are retried with backoff after
+            a timeout or a checksum error.
+        Inputs:
+            - cmd (int): the command byte.
+            - l (int): the expected data length.
+        Outputs:
+            - b (bytes): the read back data.
+        """
+        with self.lock:
+            delay = self.backoff
+            for i in range(self.retries + 1):
+                if i > 0:
+                    time.sleep(delay)
+                    delay *= 2
+                try:
+                    # drop the stale bytes, and the leftover of a failed try
+                    if i > 0 or self.ser.in_waiting > 0:
+                        self._resync()
+                    self._write(bytes([cmd]))
+                    b = self._read(l)
+                    c = self._read(1)
+                except ValonTimeout as e:
+                    # e.g. the connection to a TCP serial server is lost,
+                    # or the serial port has failed
+                    err = e
+                    continue
+                if len(b) != l or len(c) != 1:
+                    err = ValonTimeout("Read back data incorrect for 0x%02x: The length should be %d, while it's %d"%(cmd, l, len(b)))
+                elif self._verify_checksum(b, c[0]) == False:
+                    err = ValonChecksumError('Checksum is incorrect for 0x%02x.'%cmd)
+                else:
+                    return b
+            raise err
+
+    def _command(self, cmdbytes):
+        """
+        Description:
+            Send a command, and wait for ACK.
+            Commands are not retried, as a timeout doesn't tell if the
+            device has executed the command or not.
+        Inputs:
+            - cmdbytes (bytearray): the command.
+        Outputs:
+            True if ACK is received.
+        """
+        with self.lock:
+            if self.ser.in_waiting > 0:
+                self._resync()
+            self._write(cmdbytes)
+            r = self._read(1)
+            if len(r) == 0:
+                self._resync()
+                raise ValonTimeout('No reply for 0x%02x.'%cmdbytes[0])
+            if r[0] == V500X.REPLY['ACK']:
+                return True
+            self._resync()
+            if r[0] == V500X.REPLY['NACK']:
+                raise ValonNack('NACK for 0x%02x.'%cmdbytes[0])
+            raise ValonError('Unexpected reply 0x%02x for 0x%02x.'%(r[0], cmdbytes[0]))
+
+    def _registers(self, synth, fresh=True):
+        """
+        Description:
+            Get the 24 bytes register block of a synthesizer.
+        Inputs:
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - fresh (bool): read it from the device even if it's in the shadow.
+                Default=True
+        """
+        if fresh or synth not in self.shadow['regs']:
+            s = V500X.SYNTH[synth]
+            self.shadow['regs'][synth] = bytes(self._query(0x80|s, 24))
+        return self.shadow['regs'][synth]
+
+    def _write_registers(self, synth, b):
+        """
+        Description:
+            Write the 24 bytes register block of a synthesizer.
+        Inputs:
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - b (bytearray): the register block.
+        """
+        cmdbytes = bytearray(26)
+        cmdbytes[0] = 0x00|V500X.SYNTH[synth]
+        cmdbytes[1:25] = b
+        cmdbytes[25] = self._generate_checksum(cmdbytes[1:25])
+        try:
+            r = self._command(cmdbytes)
+        except ValonError:
+            # we don't know what the device has now
+            self.shadow['regs'].pop(synth, None)
+            self._written(synth)
+            raise
+        self.shadow['regs'][synth] = bytes(b)
+        self._written(synth)
+        return r
+
+    def _device_id(self):
+        """
+        Description:
+            Identify the device for the state cache: the USB serial number
+            if the port has one, or the port name.
+        """
+        return self.ser.Identity()
+
+    def _state_path(self, d=STATE_DIR):
+        return os.path.join(d, '%s.json'%_cache_name(self._device_id()))
+
+    def _decode_regs(self, regs):
+        """
+        Description:
+            Decode the register blocks saved by SaveState.
+        """
+        r = {}
+        for synth in regs:
+            if synth not in V500X.SYNTH:
+                raise ValueError('Unknown synthesizer %s.'%synth)
+            r[synth] = bytes.fromhex(regs[synth])
+            if len(r[synth]) != 24:
+                raise ValueError('The register block of %s is %d bytes.'%(synth, len(r[synth])))
+        return r
+
+    def LoadState(self, path=None):
+        """
+        Description:
+            Load the last known state of the device from the state cache.
+            The cached state is validated by reading back every cached
+            register block, and it's used only if they are all the same,
+            as a cached block is the base of the next write to it.
+        Inputs:
+            - path (str): the state cache file.
+                Default=None, the file in STATE_DIR for this device
+        Outputs:
+            True if the cached state is valid and loaded.
+        """
+        if path is None:
+            path = self._state_path()
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False
+        try:
+            if entry.get('version') != STATE_VERSION or entry.get('device') != self._device_id():
+                return False
+            regs = self._decode_regs(entry.get('regs', {}))
+            vcor = {}
+            for synth in entry.get('vcor', {}):
+                v = entry['vcor'][synth]
+                vcor[synth] = {'min': int(v['min']), 'max': int(v['max'])}
+            reference = entry.get('reference')
+            if reference is not None:
+                reference = int(reference)
+            refsel = entry.get('refsel')
+            flashed = entry.get('flashed', {})
+            flashed_regs = self._decode_regs(flashed.get('regs', {}))
+            for sel in (refsel, flashed.get('refsel')):
+                if sel not in (None, 'internal', 'external'):
+                    raise ValueError('Unknown reference selection %s.'%sel)
+            unflashed = set([str(x) for x in entry.get('unflashed', [])])
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            print('State cache not used: %s'%e)
+            return False
+        if len(regs) == 0:
+            return False
+        try:
+            for synth in sorted(regs):
+                if self._registers(synth) != regs[synth]:
+                    return False
+        except ValonError as e:
+            # start cold, the cached state is thrown away
+            print('State cache not used: %s'%e)
+            return False
+        self.shadow['reference'] = reference
+        self.shadow['vcor'] = vcor
+        self.shadow['regs'] = regs
+        self.shadow['refsel'] = refsel
+        self.flashed['regs'] = flashed_regs
+        self.flashed['refsel'] = flashed.get('refsel')
+        self.flashed['known'] = flashed.get('known', False) == True
+        self.unflashed = unflashed
+        return True
+
+    def SaveState(self, path=None):
+        """
+        Description:
+            Save the known state of the device into the state cache.
+        Inputs:
+            - path (str): the state cache file.
+                Default=None, the file in STATE_DIR for this device
+        """
+        if path is None:
+            path = self._state_path()
+        regs = {}
+        for synth in self.shadow['regs']:
+            regs[synth] = self.shadow['regs'][synth].hex()
+        flashed = {}
+        for synth in self.flashed['regs']:
+            flashed[synth] = self.flashed['regs'][synth].hex()
+        entry = {
+            'version': STATE_VERSION,
+            'device': self._device_id(),
+            'timestamp': time.time(),
+            'reference': self.shadow['reference'],
+            'vcor': self.shadow['vcor'],
+            'regs': regs,
+            'refsel': self.shadow['refsel'],
+            'flashed': {'known': self.flashed['known'], 'regs': flashed, 'refsel': self.flashed['refsel']},
+            'unflashed': sorted(self.unflashed)
+        }
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        # write a new file and rename, so that a reader never sees half of it
+        tmp = '%s.%d'%(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f, indent=1)
+        os.replace(tmp, path)
+
+    def InvalidateState(self):
+        """
+        Description:
+            Forget the known state, e.g. after the device is changed by
+            some other tools.
+        """
+        self.shadow = {'reference': None, 'vcor': {}, 'regs': {}, 'refsel': None}
+
     def close(self):
+        # flush the pending auto commit
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+            self._auto_commit()
+        if self.cache:
+            try:
+                self.SaveState(self._state_path(self.cache))
+            except OSError as e:
+                print('State cache not saved: %s'%e)
         self.ser.close()
 
     def _pack_int(self, val, d, offset):
@@ -264,7 +823,7 @@ class V500X(object):
         if len(b) != l or len(c) != 1:
             print("Read Back data incorrect: The length should be %d, while it's %d"%(l, len(b)))
             return False
-        if self._verify_checksum(b,c) == True:
+        if self._verify_checksum(b,c[0]) == False:
             print('Checksum is incorrect.')
             return False
         return True
@@ -306,15 +865,15 @@ class V500X(object):
         Outputs:
             freq (float): reference frequency in Hz
         """
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x81
-        self._write(cmdbytes)
-        b = self._read(4)
-        c = self._read(1)
-        if self.CheckReadBack(b,4,c) == False:
-            return
+        b = self._query(0x81, 4)
         freq = self._unpack_int(b, 0)
+        self.shadow['reference'] = freq
         return freq
+
+    def _reference(self):
+        if self.shadow['reference'] is None:
+            return self.GetReference()
+        return self.shadow['reference']
     
     def SetReference(self):
         #TODO: not implemented
@@ -334,13 +893,9 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x80|s
-        self._write(cmdbytes)
-        b = self._read(24)
-        c = self._read(1)
-        if self.CheckReadBack(b, 24, c) == False:
-            return
+        return self._parse_options(self._registers(synth))
+
+    def _parse_options(self, b):
         reg2 = self._unpack_int(b, 8)
         opts = {}
         opts['low_spur'] = ((reg2 >> 30) & 1) & ((reg2 >> 29) & 1);
@@ -367,8 +922,8 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        reference = self.GetReference()
-        opts = self.GetOptions(synth)
+        reference = self._reference()
+        opts = self._parse_options(self._registers(synth, fresh=False))
         if verbose:
             print('reference: ', reference)
             print('double_ref: ', opts['double_ref'])
@@ -398,18 +953,18 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x83|s
-        self._write(cmdbytes)
-        b = self._read(4)
-        c = self._read(1)
-        if self.CheckReadBack(b,4,c) == False:
-            return
+        b = self._query(0x83|s, 4)
         vcor = {}
         vcor['min'] = self._unpack_short(b,0)
         vcor['max'] = self._unpack_short(b,2)
+        self.shadow['vcor'][synth] = vcor
         return vcor
 
+    def _vco_range(self, synth):
+        if synth not in self.shadow['vcor']:
+            return self.GetVCORange(synth)
+        return self.shadow['vcor'][synth]
+
     def SetVCORange(self):
         # TODO: not implemented
         return NotImplemented
@@ -428,13 +983,7 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x80|s
-        self._write(cmdbytes)
-        b = self._read(24)
-        c = self._read(1)
-        if self.CheckReadBack(b,24,c) == False:
-            return
+        b = self._registers(synth)
         EPDF = self.GetEPDF(synth)
         regs = self._unpack_freq_registers(b)
         if verbose:
@@ -466,7 +1015,7 @@ class V500X(object):
             print('synth is not supported.')
             return
         dbf = 1
-        vcor = self.GetVCORange(synth)
+        vcor = self._vco_range(synth)
         while (freq * dbf) <= vcor['min'] and dbf <= 16:
             dbf *= 2
         if dbf > 16:
@@ -494,25 +1043,9 @@ class V500X(object):
             print('mod:', regs['mod'])
             
         #Write values to hardware
-        cmdbyte = bytearray(1)
-        cmdbyte[0] = 0x80|s
-        self._write(cmdbyte)
-        b = self._read(24)
-        c = self._read(1)
-        if self.CheckReadBack(b,24,c) == False:
-            return
-        cmdbytes = bytearray(26)
-        cmdbytes[0] = 0x00|s
-        cmdbytes[1:25] = b
-        self._pack_freq_registers(regs, cmdbytes, 1)
-        cmdbytes[25] = self._generate_checksum(cmdbytes[1:25])
-        self._write(cmdbytes)
-        r = self._read(1)
-        r = struct.unpack('b', r)[0]
-        if r == V500X.REPLY['ACK']:
-            return True
-        else:
-            return False
+        b = bytearray(self._registers(synth, fresh=False))
+        self._pack_freq_registers(regs, b, 0)
+        return self._write_registers(synth, b)
     
     def GetRFLevel(self, synth, verbose=False):
         """
@@ -528,13 +1061,7 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x80|s
-        self._write(cmdbytes)
-        b = self._read(24)
-        c = self._read(1)
-        if self.CheckReadBack(b,24,c) == False:
-            return
+        b = self._registers(synth)
         reg4 = self._unpack_int(b, 16)
         if verbose:
             print('raw reg data:', b)
@@ -575,28 +1102,12 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbyte = bytearray(1)
-        cmdbyte[0] = 0x80|s
-        self._write(cmdbyte)
-        b = self._read(24)
-        c = self._read(1)
-        if self.CheckReadBack(b,24,c) == False:
-            return
+        b = bytearray(self._registers(synth, fresh=False))
         reg4 = self._unpack_int(b, 16)
         reg4 &= 0xffffffe7
         reg4 |= (rfl & 0x03) << 3
-        cmdbytes = bytearray(26)
-        cmdbytes[0] = 0x00|s
-        cmdbytes[1:25] = b
-        self._pack_int(reg4, cmdbytes, 17)
-        cmdbytes[25] = self._generate_checksum(b)
-        self._write(cmdbytes)
-        r = self._read(1)
-        r = struct.unpack('b', r)[0]
-        if r == V500X.REPLY['ACK']:
-            return True
-        else:
-            return False
+        self._pack_int(reg4, b, 16)
+        return self._write_registers(synth, b)
 
     def GetPhaseLock(self, synth, verbose=False):
         """
@@ -612,13 +1123,7 @@ class V500X(object):
         except:
             print('synth is not supported.')
             return
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x86|s
-        self._write(cmdbytes)
-        b = self._read(1)
-        c = self._read(1)
-        if self.CheckReadBack(b,1,c) == False:
-            return
+        b = self._query(0x86|s, 1)
         if synth == 'A':
             mask = 0x20
         elif synth == 'B':
@@ -631,6 +1136,104 @@ class V500X(object):
         else:
             return False
 
+    def _settle(self, synth, freq, timeout):
+        """
+        Description:
+            Set the frequency, and measure the time from the ACK until
+            the synthesizer is locked.
+        Outputs:
+            - t (float): settle time in seconds, None if not locked in time.
+        """
+        self.SetFreq(synth, freq)
+        # monotonic, as a jump of the wall clock would spoil the timing
+        t0 = time.monotonic()
+        while True:
+            if self.GetPhaseLock(synth):
+                return time.monotonic() - t0
+            if time.monotonic() - t0 > timeout:
+                return None
+
+    def CharacterizeSettle(self, synth, freqs, samples=3, timeout=1.0, verbose=False):
+        """
+        Description:
+            Measure the settle time of a synthesizer at each frequency.
+            Each sample jumps from the neighbouring frequency, and is the time
+            from the ACK of the register write until the synthesizer reports
+            locked, so it's limited by the round trip of GetPhaseLock.
+        Inputs:
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - freqs (list): frequencies in MHz, at least 2.
+            - samples (int): number of samples at each frequency, at least 1.
+                Default=3
+            - timeout (float): max time in seconds to wait for the lock.
+                Default=1.0
+        Outputs:
+            - table (SettleTable): the worst settle time at each frequency,
+              None at the frequencies never locked.
+        """
+        freqs = sorted(set(freqs))
+        # each point is reached from its neighbour
+        if len(freqs) < 2:
+            raise ValueError('At least 2 different frequencies are needed to measure the settle time.')
+        if samples < 1:
+            raise ValueError('At least 1 sample is needed at each frequency, while it is %s.'%samples)
+        settle = []
+        for i in range(len(freqs)):
+            if i > 0:
+                away = freqs[i-1]
+            else:
+                away = freqs[1]
+            ts = []
+            for k in range(samples):
+                self._settle(synth, away, timeout)
+                ts.append(self._settle(synth, freqs[i], timeout))
+            if None in ts:
+                settle.append(None)
+            else:
+                settle.append(max(ts))
+            if verbose:
+                print('%.03f MHz: %s'%(freqs[i], ts))
+        return SettleTable(self._device_id(), synth, freqs, settle)
+
+    def LoadSettleTable(self, synth, path=None):
+        """
+        Description:
+            Load the settle time table of a synthesizer of this device.
+        Inputs:
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - path (str): the table file.
+                Default=None, the file in SETTLE_DIR for this device
+        Outputs:
+            - table (SettleTable): None if there is no table.
+        """
+        if path is None:
+            path = SettleTable.DefaultPath(self._device_id(), synth)
+        try:
+            return SettleTable.Load(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def Hop(self, synth, freq, table=None, dwell=0.0):
+        """
+        Description:
+            Set the frequency, and wait until the output is settled.
+        Inputs:
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - freq (float): the output frequency in MHz.
+            - table (SettleTable): the settle time table, to wait only as
+              long as this frequency needs.
+                Default=None
+            - dwell (float): time in seconds to wait without a table, or
+              in addition to the table.
+                Default=0.0
+        """
+        r = self.SetFreq(synth, freq)
+        if table is not None:
+            dwell += table.Dwell(freq)
+        if dwell > 0:
+            time.sleep(dwell)
+        return r
+
     def GetRefSelect(self):
         """
         Description:
@@ -638,18 +1241,14 @@ class V500X(object):
         Outpus:
             - sel (str): 'external' or 'internal'
         """
-        cmdbytes = bytearray(1)
-        cmdbytes[0] = 0x86
-        self._write(cmdbytes)
-        b = self._read(1)
-        c = self._read(1)
-        if self.CheckReadBack(b,1,c) == False:
-            return
+        b = self._query(0x86, 1)
         s = struct.unpack('b', b)[0]
         if s&1:
-            return 'external'
+            sel = 'external'
         else:
-            return 'internal'
+            sel = 'internal'
+        self.shadow['refsel'] = sel
+        return sel
     
     def SetRefSelect(self, sel='external'):
         """
@@ -669,25 +1268,104 @@ class V500X(object):
         cmdbytes[0] = 0x06
         cmdbytes[1] = s & 1
         cmdbytes[2] = self._generate_checksum(cmdbytes[:2])
-        self._write(cmdbytes)
-        r = self._read(1)
-        r = struct.unpack('b', r)[0]
-        if r == V500X.REPLY['ACK']:
-            return True
-        else:
-            return False
+        try:
+            r = self._command(cmdbytes)
+        except ValonError:
+            self.shadow['refsel'] = None
+            self._written('refsel')
+            raise
+        self.shadow['refsel'] = sel
+        self._written('refsel')
+        return r
 
     def Flash(self):
+        """
+        Description:
+            Write the current settings into flash.
+        """
         cmdbytes = bytearray(2)
         cmdbytes[0] = 0x40
         cmdbytes[1] = self._generate_checksum([cmdbytes[0]])
-        self._write(cmdbytes)
-        r = self._read(1)
-        r = struct.unpack('b', r)[0]
-        if r == V500X.REPLY['ACK']:
+        with self.lock:
+            r = self._command(cmdbytes)
+            self.flashed['regs'] = dict(self.shadow['regs'])
+            self.flashed['refsel'] = self.shadow['refsel']
+            self.flashed['known'] = True
+            self.unflashed = set()
+        return r
+
+    def _written(self, item):
+        """
+        Description:
+            Record a write, and restart the auto commit timer.
+        Inputs:
+            - item (str): 'A', 'B' or 'refsel'.
+        """
+        self.unflashed.add(item)
+        if self.commit_delay is not None:
+            if self.commit_timer is not None:
+                self.commit_timer.cancel()
+            self.commit_timer = threading.Timer(self.commit_delay, self._auto_commit)
+            self.commit_timer.daemon = True
+            self.commit_timer.start()
+
+    def _auto_commit(self):
+        try:
+            self.Commit()
+        except ValonError as e:
+            print('Auto commit faild: %s'%e)
+
+    def IsDirty(self):
+        """
+        Description:
+            Check if the settings have been changed since the last flash.
+        Outputs:
+            True if the settings are different from the flash, or if the
+            flash content is unknown, e.g. without the state cache.
+        """
+        # nothing known about the flash, so it may differ from the settings
+        if not self.flashed['known']:
             return True
-        else:
-            return False
+        cur = dict(self.shadow['regs'])
+        cur['refsel'] = self.shadow['refsel']
+        base = dict(self.flashed['regs'])
+        base['refsel'] = self.flashed['refsel']
+        for item in self.unflashed | set(base):
+            if cur.get(item) is None or base.get(item) is None:
+                if item in self.unflashed:
+                    return True
+            elif cur[item] != base[item]:
+                return True
+        return False
+
+    def Commit(self):
+        """
+        Description:
+            Write the settings into flash, only if they have been changed
+            since the last flash.
+        Outputs:
+            True if the flash is written, False if nothing changed.
+        """
+        with self.lock:
+            if not self.IsDirty():
+                return False
+            return self.Flash()
+
+    def AutoCommit(self, delay=1.0):
+        """
+        Description:
+            Commit automatically, delay seconds after the last write, so that
+            a burst of changes ends up in one flash write.
+            The pending commit is also done when the device is closed.
+        Inputs:
+            - delay (float): seconds to wait after the last write, None to
+              stop the auto commit.
+                Default=1.0
+        """
+        self.commit_delay = delay
+        if delay is None and self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
 
 class V5007(V500X):
     """
@@ -701,4 +1379,94 @@ class V5008(V500X):
     Description:
         The communication protocol for V5008 is totally same as V500X.
     """
-    pass
\ No newline at end of file
+    pass
+
+class SettleTable(object):
+    """
+    Description:
+        The settle time of a synthesizer at each frequency,
+        made by V500X.CharacterizeSettle.
+    """
+    def __init__(self, device, synth, freqs, settle, timestamp=None):
+        """
+        Inputs:
+            - device (str): the device identity.
+            - synth (str): A - synthesizer 1; B - synthesizer 2.
+            - freqs (list): sorted frequencies in MHz.
+            - settle (list): settle time in seconds at each frequency,
+              None if never locked.
+            - timestamp (float): when the table was made.
+                Default=None, now
+        """
+        self.device = device
+        self.synth = synth
+        self.freqs = freqs
+        self.settle = settle
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+    def Dwell(self, freq):
+        """
+        Description:
+            Get the time to wait after setting the frequency: the worst of
+            the two measured frequencies around it. The frequencies never
+            locked are skipped, and outside the measured band the worst
+            case is used.
+        Inputs:
+            - freq (float): the frequency in MHz.
+        Outputs:
+            - dwell (float): time in seconds.
+        """
+        near = []
+        # outside the band, the edge point tells nothing about it
+        if len(self.freqs) > 0 and freq >= self.freqs[0] and freq <= self.freqs[-1]:
+            i = bisect.bisect_left(self.freqs, freq)
+            near = [self.settle[j] for j in (i-1, i) if j >= 0 and j < len(self.freqs)]
+            near = [x for x in near if x is not None]
+        if len(near) == 0:
+            # nothing measured around it, use the worst case
+            near = [x for x in self.settle if x is not None]
+        if len(near) == 0:
+            return 0.0
+        return max(near)
+
+    @staticmethod
+    def DefaultPath(device, synth):
+        return os.path.join(SETTLE_DIR, '%s_%s.json'%(_cache_name(device), synth))
+
+    def Save(self, path=None):
+        """
+        Description:
+            Save the table.
+        Inputs:
+            - path (str): the table file.
+                Default=None, the file in SETTLE_DIR for this device
+        """
+        if path is None:
+            path = SettleTable.DefaultPath(self.device, self.synth)
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'version': STATE_VERSION,
+                'device': self.device,
+                'synth': self.synth,
+                'timestamp': self.timestamp,
+                'freqs': self.freqs,
+                'settle': self.settle
+            }, f)
+        return path
+
+    @staticmethod
+    def Load(path):
+        """
+        Description:
+            Load a table saved by Save.
+        """
+        with open(path) as f:
+            d = json.load(f)
+        if d.get('version') != STATE_VERSION:
+            raise ValueError('Unsupported settle table version.')
+        return SettleTable(d['device'], d['synth'], d['freqs'], d['settle'], d['timestamp'])
@@ -0,0 +1,232 @@
+
+import time
+import multiprocessing
+import multiprocessing.connection
+
+class ValonFleet(object):
+    """
+    Description:
+        Drive many valon devices from worker processes.
+        The devices are sharded across the workers, one worker per USB hub
+        or per N ports, and stay open in their worker, so the serial I/O of
+        different shards runs in parallel on different cores.
+    """
+    def __init__(self, devices, ports_per_worker=8, context=None):
+        """
+        Inputs:
+            - devices (dict): device name -> device description, such as
+                {'model': 'V5008', 'dev': '/dev/ttyUSB0', 'baud': 9600, 'hub': 'hub0'}
+              'model' is the class name in Valon.py, 'baud' and 'hub' are optional.
+              The devices on the same hub go to the same worker(s).
+            - ports_per_worker (int): the max number of devices in one worker.
+                Default=8
+            - context (str): multiprocessing start method, such as 'spawn'.
+                Default=None, the platform default
+        """
+        self.ctx = multiprocessing.get_context(context)
+        self.shards = self._shard(devices, ports_per_worker)
+        self.workers = []
+        self.owner = {}
+        for i in range(len(self.shards)):
+            self.workers.append(self._start(i))
+            for name in self.shards[i]:
+                self.owner[name] = i
+        self.tag = 0
+        self.stats = {}
+        for name in devices:
+            self.stats[name] = {'ops': 0, 'errors': 0, 'busy': 0.0}
+        self.fleet_ops = 0
+        self.fleet_time = 0.0
+
+    def _start(self, i):
+        parent, child = self.ctx.Pipe()
+        p = self.ctx.Process(target=_worker, args=(child, self.shards[i]), daemon=True)
+        p.start()
+        child.close()
+        return (p, parent)
+
+    def _restart(self, i):
+        """
+        Description:
+            Replace a dead worker with a new one. Its devices are opened
+            again by the new worker on their next call.
+        """
+        p, conn = self.workers[i]
+        conn.close()
+        if p.is_alive():
+            p.terminate()
+        p.join(1)
+        self.workers[i] = self._start(i)
+
+    def _shard(self, devices, n):
+        hubs = {}
+        for name in devices:
+            hubs.setdefault(devices[name].get('hub'), []).append(name)
+        shards = []
+        for hub in hubs:
+            names = hubs[hub]
+            for i in range(0, len(names), n):
+                shards.append(dict([(x, devices[x]) for x in names[i:i+n]]))
+        return shards
+
+    def Map(self, method, calls):
+        """
+        Description:
+            Call a method on several devices in parallel.
+        Inputs:
+            - method (str): the method name, such as 'SetFreq'.
+            - calls (dict): device name -> (args, kwargs) of the call.
+        Outputs:
+            - r (dict): device name -> result.
+              The devices failed map to the exception raised by the call,
+              such as ValonTimeout or ValonNack, or to a ValonError if
+              their worker has died. A dead worker is restarted.
+        """
+        t0 = time.time()
+        # tag -> (device name, worker index)
+        pending = {}
+        r = {}
+        dead = set()
+        for name in calls:
+            args, kwargs = calls[name]
+            i = self.owner[name]
+            self.tag += 1
+            if i in dead:
+                self._fail(r, name, 'worker died')
+                continue
+            try:
+                self.workers[i][1].send((self.tag, name, method, args, kwargs))
+                pending[self.tag] = (name, i)
+            except (BrokenPipeError, EOFError, OSError):
+                dead.add(i)
+                self._fail(r, name, 'worker died')
+        while len(pending) > 0:
+            busy = set([x[1] for x in pending.values()])
+            conns = dict([(self.workers[i][1], i) for i in busy])
+            for conn in multiprocessing.connection.wait(list(conns)):
+                i = conns[conn]
+                try:
+                    tag, name, ok, res, elapsed = conn.recv()
+                except (EOFError, OSError):
+                    # the worker died, so do all its calls
+                    dead.add(i)
+                    for tag in [x for x in pending if pending[x][1] == i]:
+                        self._fail(r, pending.pop(tag)[0], 'worker died')
+                    continue
+                # a late reply to an earlier call, which has been given up
+                if tag not in pending:
+                    continue
+                del pending[tag]
+                st = self.stats[name]
+                st['ops'] += 1
+                st['busy'] += elapsed
+                if not ok:
+                    st['errors'] += 1
+                r[name] = res
+        for i in dead:
+            self._restart(i)
+        self.fleet_ops += len(calls)
+        self.fleet_time += time.time() - t0
+        return r
+
+    def _fail(self, r, name, reason):
+        from Valon import ValonError
+        self.stats[name]['ops'] += 1
+        self.stats[name]['errors'] += 1
+        r[name] = ValonError('%s: %s'%(name, reason))
+
+    def Broadcast(self, method, *args, names=None, **kwargs):
+        """
+        Description:
+            Call a method with the same arguments on many devices.
+        Inputs:
+            - method (str): the method name, such as 'GetPhaseLock'.
+            - names (list): the devices to call.
+                Default=None, all the devices
+        Outputs:
+            - r (dict): device name -> result, see Map.
+        """
+        if names is None:
+            names = self.owner.keys()
+        return self.Map(method, dict([(x, (args, kwargs)) for x in names]))
+
+    def Call(self, name, method, *args, **kwargs):
+        """
+        Description:
+            Call a method on one device.
+        Outputs:
+            - r: the result, raises the exception of the call if it failed.
+        """
+        r = self.Map(method, {name: (args, kwargs)})[name]
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    def Stats(self):
+        """
+        Description:
+            Get the throughput of each device and of the whole fleet.
+        Outputs:
+            - stats (dict): {'devices': {name: {...}}, 'fleet': {...}}.
+              'ops_per_sec' of a device is based on the time spent in its own
+              calls, while the fleet one is based on the wall time.
+        """
+        devs = {}
+        for name in self.stats:
+            st = dict(self.stats[name])
+            st['ops_per_sec'] = st['ops'] / st['busy'] if st['busy'] > 0 else 0.0
+            devs[name] = st
+        fleet = {
+            'workers': len(self.workers),
+            'devices': len(self.stats),
+            'ops': self.fleet_ops,
+            'time': self.fleet_time,
+            'ops_per_sec': self.fleet_ops / self.fleet_time if self.fleet_time > 0 else 0.0
+        }
+        return {'devices': devs, 'fleet': fleet}
+
+    def close(self):
+        for p, conn in self.workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for p, conn in self.workers:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+            conn.close()
+        self.workers = []
+
+def _worker(conn, devices):
+    """
+    Description:
+        Worker process: keep the devices of one shard open,
+        and run the commands from the parent one by one.
+    """
+    import Valon
+    synths = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        tag, name, method, args, kwargs = msg
+        t0 = time.time()
+        try:
+            if name not in synths:
+                d = devices[name]
+                cls = getattr(Valon, d['model'])
+                synths[name] = cls(d['dev'], d.get('baud', 9600))
+            res = getattr(synths[name], method)(*args, **kwargs)
+            ok = True
+        except Exception as e:
+            res = e
+            ok = False
+        try:
+            conn.send((tag, name, ok, res, time.time() - t0))
+        except Exception:
+            # the result or the exception can't be pickled
+            conn.send((tag, name, False, Valon.ValonError('%s: %s'%(type(res).__name__, res)), time.time() - t0))
+    for synth in synths.values():
+        synth.close()
+    conn.close()
@@ -0,0 +1,370 @@
+
+import time
+import socket
+import select
+
+# open socket connections, (host, port) -> SocketTransport
+POOL = {}
+
+class Transport(object):
+    """
+    Description:
+        The byte stream to a valon device, with the pyserial interface used by
+        Valon and V500X: write, read, in_waiting, reset_input_buffer and close.
+        It also keeps the transport-level statistics.
+    """
+    def __init__(self, port, timeout):
+        self.port = port
+        self.timeout = timeout
+        self.stats = {'writes': 0, 'bytes_out': 0, 'bytes_in': 0, 'replies': 0, 'latency': 0.0, 'latency_max': 0.0}
+        self.t_write = None
+
+    def _sent(self, d):
+        self.stats['writes'] += 1
+        self.stats['bytes_out'] += len(d)
+        if self.t_write is None:
+            self.t_write = time.time()
+
+    def _received(self, d):
+        if len(d) == 0:
+            return
+        self.stats['bytes_in'] += len(d)
+        # latency: from a write until the first byte back
+        if self.t_write is not None:
+            t = time.time() - self.t_write
+            self.t_write = None
+            self.stats['replies'] += 1
+            self.stats['latency'] += t
+            self.stats['latency_max'] = max(self.stats['latency_max'], t)
+
+    def Stats(self):
+        """
+        Description:
+            Get the transport statistics.
+        Outputs:
+            - stats (dict): the number of writes and bytes in each direction,
+              and the average and max latency in seconds from a write to the
+              first byte back.
+        """
+        st = dict(self.stats)
+        st['latency_avg'] = st['latency'] / st['replies'] if st['replies'] > 0 else 0.0
+        del st['latency']
+        return st
+
+    def Identity(self):
+        """
+        Description:
+            Identify the device behind the transport, e.g. for the state cache.
+        """
+        return self.port
+
+class SerialTransport(Transport):
+    """
+    Description:
+        Local serial port.
+        A port failure, such as the SerialException of a USB hub glitch,
+        raises ValonTimeout, and the port is opened again on the next write.
+    """
+    def __init__(self, dev, baud, timeout=0.5):
+        Transport.__init__(self, dev, timeout)
+        # pyserial is only imported once a device is actually opened
+        import serial
+        self.ser = serial.Serial(dev,baud,timeout=timeout, rtscts=False, xonxoff=False)
+        self.broken = False
+
+    def _lost(self, reason):
+        """
+        Description:
+            Report a port failure as a timeout, so that the reads are retried.
+            SerialException is an OSError, like the errors of the OS itself.
+        """
+        from Valon import ValonTimeout
+        self.broken = True
+        self.t_write = None
+        raise ValonTimeout('%s: port failed(%s).'%(self.port, reason))
+
+    @property
+    def in_waiting(self):
+        if self.broken:
+            return 0
+        try:
+            return self.ser.in_waiting
+        except OSError:
+            # the next write opens the port again
+            self.broken = True
+            return 0
+
+    def write(self, d):
+        if self.broken:
+            try:
+                self.ser.close()
+                self.ser.open()
+            except OSError as e:
+                self._lost(e)
+            self.broken = False
+        self._sent(d)
+        try:
+            return self.ser.write(d)
+        except OSError as e:
+            self._lost(e)
+
+    def read(self, n):
+        try:
+            d = self.ser.read(n)
+        except OSError as e:
+            self._lost(e)
+        self._received(d)
+        return d
+
+    def reset_input_buffer(self):
+        if not self.broken:
+            try:
+                self.ser.reset_input_buffer()
+            except OSError:
+                self.broken = True
+        self.t_write = None
+
+    def Identity(self):
+        """
+        Description:
+            The USB serial number if the port has one, or the port name.
+        """
+        try:
+            from serial.tools import list_ports
+            for p in list_ports.comports():
+                if p.device == self.port and p.serial_number:
+                    return 'usb:%s'%p.serial_number
+        except ImportError:
+            pass
+        return self.port
+
+    def close(self):
+        self.ser.close()
+
+class SocketTransport(Transport):
+    """
+    Description:
+        TCP serial server, such as ser2net, at socket://host:port.
+        Small frames are written without Nagle delay, and the connection is
+        kept alive in POOL when closed, to be reused by the next open.
+        A connection lost in the middle raises ValonTimeout, and it's
+        connected again on the next write.
+    """
+    # max time in seconds for a write to get into the socket
+    WRITE_TIMEOUT = 5
+
+    def __init__(self, host, port, timeout=0.5):
+        Transport.__init__(self, 'socket://%s:%d'%(host, port), timeout)
+        self.addr = (host, port)
+        self.buf = b''
+        self.users = 0
+        self.sock = None
+        self._connect()
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.addr, timeout=5)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # blocking writes, select is used for the reads
+        self.sock.settimeout(SocketTransport.WRITE_TIMEOUT)
+        self.buf = b''
+
+    def _lost(self, reason):
+        """
+        Description:
+            Drop the connection, and report it as a timeout, so that the
+            reads are retried, on a new connection.
+        """
+        from Valon import ValonTimeout
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.buf = b''
+        self.t_write = None
+        raise ValonTimeout('%s: connection lost(%s).'%(self.port, reason))
+
+    def _fill(self, wait):
+        """
+        Description:
+            Move the received data into buf, waiting at most wait seconds.
+        """
+        if self.sock is None:
+            return False
+        r, w, x = select.select([self.sock], [], [], wait)
+        if len(r) == 0:
+            return False
+        try:
+            d = self.sock.recv(65536)
+        except OSError as e:
+            self._lost(e)
+        if len(d) == 0:
+            self._lost('closed by the server')
+        self.buf += d
+        return True
+
+    def Alive(self):
+        """
+        Description:
+            Check if the connection is still open.
+        """
+        if self.sock is None:
+            return False
+        try:
+            while self._fill(0):
+                pass
+        except Exception:
+            return False
+        return True
+
+    @property
+    def in_waiting(self):
+        try:
+            while self._fill(0):
+                pass
+        except Exception:
+            # lost, the next write connects again
+            pass
+        return len(self.buf)
+
+    def write(self, d):
+        if self.sock is None:
+            try:
+                self._connect()
+            except OSError as e:
+                self._lost(e)
+        self._sent(d)
+        try:
+            self.sock.sendall(bytes(d))
+        except OSError as e:
+            self._lost(e)
+        return len(d)
+
+    def read(self, n):
+        # like pyserial: wait until n bytes, or timeout
+        t_end = time.time() + self.timeout
+        while len(self.buf) < n:
+            wait = t_end - time.time()
+            if wait <= 0 or not self._fill(wait):
+                break
+        d = self.buf[:n]
+        self.buf = self.buf[n:]
+        self._received(d)
+        return d
+
+    def reset_input_buffer(self):
+        try:
+            while self._fill(0):
+                pass
+        except Exception:
+            # lost, the next write connects again
+            pass
+        self.buf = b''
+        self.t_write = None
+
+    def close(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+        # keep the connection in POOL for the next open
+        if POOL.get(self.addr) is None and self.sock is not None:
+            POOL[self.addr] = self
+        if POOL.get(self.addr) is self:
+            self.reset_input_buffer()
+        else:
+            self.Shutdown()
+
+    def Shutdown(self):
+        """
+        Description:
+            Really close the connection, and remove it from POOL.
+        """
+        if POOL.get(self.addr) is self:
+            del POOL[self.addr]
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class MemoryTransport(Transport):
+    """
+    Description:
+        In-memory device, for testing without hardware.
+        The responder gets everything written, and returns the bytes
+        to be read back. Without a responder it's a loopback.
+    """
+    def __init__(self, responder=None, timeout=0.5):
+        Transport.__init__(self, 'loop://', timeout)
+        self.responder = responder
+        self.buf = b''
+
+    @property
+    def in_waiting(self):
+        return len(self.buf)
+
+    def write(self, d):
+        self._sent(d)
+        if self.responder is None:
+            self.buf += bytes(d)
+        else:
+            self.buf += self.responder(bytes(d))
+        return len(d)
+
+    def read(self, n):
+        d = self.buf[:n]
+        self.buf = self.buf[n:]
+        self._received(d)
+        return d
+
+    def reset_input_buffer(self):
+        self.buf = b''
+        self.t_write = None
+
+    def close(self):
+        pass
+
+def OpenTransport(dev, baud, timeout=0.5):
+    """
+    Description:
+        Open the transport for a device.
+    Inputs:
+        - dev (str or Transport): 'socket://host:port' for a TCP serial
+          server, 'loop://' for an in-memory loopback, a Transport as it is,
+          or a serial port.
+        - baud (int): baud rate, only for serial ports.
+        - timeout (float): read timeout in seconds.
+            Default=0.5
+    Outputs:
+        - t (Transport): the transport.
+          An idle pooled connection is reused for socket://, while a
+          connection in use is never shared.
+    """
+    if isinstance(dev, Transport):
+        return dev
+    if dev.startswith('socket://'):
+        host, port = dev[len('socket://'):].rsplit(':', 1)
+        addr = (host, int(port))
+        t = POOL.get(addr)
+        if t is not None and t.users == 0 and not t.Alive():
+            t.Shutdown()
+            t = None
+        if t is None:
+            t = SocketTransport(host, int(port), timeout)
+            POOL[addr] = t
+        elif t.users > 0:
+            # in use by another object, which must keep its own stream
+            t = SocketTransport(host, int(port), timeout)
+        else:
+            t.reset_input_buffer()
+        t.timeout = timeout
+        t.users += 1
+        return t
+    if dev.startswith('loop://'):
+        return MemoryTransport(timeout=timeout)
+    return SerialTransport(dev, baud, timeout)
+
+def ClosePool():
+    """
+    Description:
+        Close all the pooled connections.
+    """
+    for t in list(POOL.values()):
+        t.Shutdown()
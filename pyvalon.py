@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+"""
+usage: pyvalon.py [-h] [--script SCRIPT] [{v5015,v5008,v5007} ...]
+
+Single entry point for all the Valon synthesizers.
+
+positional arguments:
+  {v5015,v5008,v5007}  The device model, followed by the options of v5015.py or v5008.py
+
+optional arguments:
+  -h, --help       show this help message and exit
+  --script SCRIPT  Run the commands in SCRIPT ('-' for stdin), one command per line
+
+Example of a script file:
+    # comments and empty lines are ignored
+    v5015 --dev /dev/ttyUSB1 --freq 50 --amp 4
+    v5015 --dev /dev/ttyUSB1 --rfout on --pwr on
+    v5008 --dev /dev/ttyUSB0 --synth A --freq 1000
+
+All the commands run in one process, and each device is opened only once
+and shared by all the commands addressed to it.
+"""
+import sys
+import shlex
+from argparse import ArgumentParser, REMAINDER
+
+# model name -> (cli module, Valon class)
+MODELS = {
+    'v5015': ('v5015', 'V5015'),
+    'v5008': ('v5008', 'V5008'),
+    'v5007': ('v5008', 'V5007'),
+}
+
+def ReadScript(fname):
+    """
+    Description:
+        Read the commands from a script file.
+    Inputs:
+        - fname (str): the script file name, '-' for stdin.
+    Outputs:
+        - cmds (list): each command is a list of arguments.
+    """
+    if fname == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(fname) as f:
+            lines = f.readlines()
+    cmds = []
+    for line in lines:
+        argv = shlex.split(line, comments=True)
+        if len(argv) > 0:
+            cmds.append(argv)
+    return cmds
+
+class Session(object):
+    """
+    Description:
+        Run commands against Valon devices, keeping every device open
+        until the session is closed.
+    """
+    def __init__(self):
+        self.devs = {}
+
+    def _open(self, model, args):
+        key = (model, args.dev, args.baud)
+        if key not in self.devs:
+            # Valon (and pyserial) is only imported when a device is used
+            import Valon
+            cls = getattr(Valon, MODELS[model][1])
+            if hasattr(args, 'cache'):
+                self.devs[key] = cls(args.dev, args.baud, cache=args.cache)
+            else:
+                self.devs[key] = cls(args.dev, args.baud)
+        return self.devs[key]
+
+    def Run(self, argv):
+        """
+        Description:
+            Run one command.
+        Inputs:
+            - argv (list): the model name followed by its options.
+        """
+        model = argv[0].lower()
+        if model not in MODELS:
+            print('%s is not supported.'%argv[0])
+            return
+        cli = __import__(MODELS[model][0])
+        args = cli.BuildParser().parse_args(argv[1:])
+        if not cli.HasWork(args):
+            return
+        synth = self._open(model, args)
+        cli.Run(synth, args)
+
+    def close(self):
+        for synth in self.devs.values():
+            synth.close()
+        self.devs = {}
+
+def main():
+    parser = ArgumentParser(description="Single entry point for all the Valon synthesizers.")
+    parser.add_argument('--script', dest='script', type=str, default=None, help='Run the commands in SCRIPT (\'-\' for stdin), one command per line')
+    parser.add_argument('cmd', nargs=REMAINDER, help='The device model(%s), followed by the options of v5015.py or v5008.py'%(', '.join(MODELS)))
+    args = parser.parse_args()
+
+    cmds = []
+    if args.cmd:
+        cmds.append(args.cmd)
+    if args.script:
+        cmds += ReadScript(args.script)
+    if len(cmds) == 0:
+        parser.print_usage()
+        return
+    session = Session()
+    try:
+        for cmd in cmds:
+            session.Run(cmd)
+    finally:
+        session.close()
+
+if __name__=='__main__':
+    main()
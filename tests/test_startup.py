@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+
+from conftest import ROOT
+
+# the CLIs are run from shell scripts many times, so they must start fast
+MAX_STARTUP = 1.0
+
+def run(*args):
+    t0 = time.time()
+    p = subprocess.run([sys.executable] + list(args), cwd=ROOT, capture_output=True, text=True)
+    return p, time.time() - t0
+
+@pytest.mark.parametrize('args', [
+    ['v5015.py', '-h'],
+    ['v5008.py', '-h'],
+    ['pyvalon.py'],
+    ['pyvalon.py', 'v5015', '--dev', '/dev/null'],
+])
+def test_startup_time(args):
+    p, t = run(*args)
+    assert p.returncode == 0, p.stderr
+    assert t < MAX_STARTUP, '%s took %.03f s'%(' '.join(args), t)
+
+def test_noop_opens_nothing():
+    # nothing to do, so no banner and no device
+    p, t = run('v5015.py', '--dev', '/dev/does-not-exist')
+    assert p.returncode == 0, p.stderr
+    assert p.stdout == ''
+
+def test_lazy_imports():
+    code = ('import sys, v5015, v5008, pyvalon\n'
+            'print(sorted(m for m in ("serial", "Valon") if m in sys.modules))\n')
+    p, t = run('-c', code)
+    assert p.returncode == 0, p.stderr
+    assert p.stdout.strip() == '[]'
+
+def test_script(tmp_path):
+    script = tmp_path / 'cmds.txt'
+    script.write_text('# nothing to do\n\nv5015 --dev /dev/null\nv5008 --dev /dev/null\n')
+    p, t = run('pyvalon.py', '--script', str(script))
+    assert p.returncode == 0, p.stderr
+    assert t < MAX_STARTUP
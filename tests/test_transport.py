@@ -0,0 +1,126 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import ValonTransport
+from ValonTransport import OpenTransport, ClosePool, POOL
+from Valon import V500X, ValonTimeout
+
+class StandIn(object):
+    """
+    Local stand-in for a TCP serial server: echoes everything back, except
+    the V500X reference read (0x81), which gets a 10 MHz reply.
+    """
+    def __init__(self):
+        self.srv = socket.socket()
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind(('127.0.0.1', 0))
+        self.srv.listen(8)
+        self.url = 'socket://127.0.0.1:%d'%self.srv.getsockname()[1]
+        self.conns = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                c, a = self.srv.accept()
+            except OSError:
+                return
+            self.conns.append(c)
+            threading.Thread(target=self._serve, args=(c,), daemon=True).start()
+
+    def _serve(self, c):
+        while True:
+            try:
+                d = c.recv(4096)
+            except OSError:
+                return
+            if not d:
+                return
+            if d == b'\x81':
+                r = struct.pack('>i', 10000000)
+                d = r + bytes([sum(r) & 0xff])
+            c.sendall(d)
+
+    def drop(self):
+        # the server goes away from the middle of the session
+        for c in self.conns:
+            c.shutdown(socket.SHUT_RDWR)
+            c.close()
+        self.conns = []
+
+    def close(self):
+        self.drop()
+        self.srv.close()
+
+@pytest.fixture
+def server():
+    s = StandIn()
+    yield s
+    ClosePool()
+    s.close()
+
+def echo(t, d=b'ping'):
+    t.write(d)
+    return t.read(len(d))
+
+def wait_connections(server, n):
+    t_end = time.time() + 2
+    while len(server.conns) < n and time.time() < t_end:
+        time.sleep(0.01)
+    return len(server.conns)
+
+def test_pool_reuse(server):
+    t1 = OpenTransport(server.url, 9600)
+    assert echo(t1) == b'ping'
+    t1.close()
+    t2 = OpenTransport(server.url, 9600)
+    assert t2 is t1
+    assert echo(t2) == b'ping'
+    assert wait_connections(server, 1) == 1
+    st = t2.Stats()
+    assert st['writes'] == 2 and st['bytes_in'] == 8 and st['replies'] == 2
+
+def test_no_sharing_in_use(server):
+    t1 = OpenTransport(server.url, 9600)
+    t2 = OpenTransport(server.url, 9600)
+    assert t2 is not t1
+    t1.write(b'one')
+    assert echo(t2, b'two') == b'two'
+    assert t1.read(3) == b'one'
+    t2.close()
+    t1.close()
+    # only one connection stays in the pool
+    assert POOL[t1.addr] is t1
+    assert t2.sock is None
+
+def test_dead_connection_replaced(server):
+    t1 = OpenTransport(server.url, 9600)
+    echo(t1)
+    t1.close()
+    server.drop()
+    time.sleep(0.05)
+    t2 = OpenTransport(server.url, 9600)
+    assert t2 is not t1
+    assert echo(t2) == b'ping'
+
+def test_lost_in_session(server):
+    t = OpenTransport(server.url, 9600, timeout=0.2)
+    echo(t)
+    server.drop()
+    with pytest.raises(ValonTimeout):
+        t.write(b'x')
+        t.read(1)
+    # connected again on the next write
+    assert echo(t) == b'ping'
+
+def test_v500x_over_socket(server):
+    synth = V500X(server.url)
+    assert synth.GetReference() == 10000000
+    server.drop()
+    # the read is retried on a new connection
+    assert synth.GetReference() == 10000000
+    synth.close()
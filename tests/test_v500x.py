@@ -0,0 +1,353 @@
+import struct
+import time
+
+import pytest
+
+import v5008
+from Valon import V500X, SettleTable, ValonError, ValonTimeout, ValonChecksumError, ValonNack
+from ValonTransport import Transport, SerialTransport, MemoryTransport
+
+ACK = b'\x06'
+NACK = b'\x15'
+
+def frame(d):
+    return bytes(d) + bytes([sum(d) & 0xff])
+
+class FakeV500X(object):
+    """
+    In-memory V5007/V5008, with the binary protocol of V500X:
+    the register blocks, the reference, the VCO range and the status.
+    """
+    def __init__(self):
+        self.regs = {'A': bytes(24), 'B': bytes(24)}
+        self.reference = 10000000
+        self.refsel = 0
+        self.flashes = 0
+        self.commands = []
+        # replies used instead of the next ones, e.g. b'' for no reply
+        self.replies = []
+
+    def __call__(self, d):
+        self.commands.append(d)
+        if len(self.replies) > 0:
+            return self.replies.pop(0)
+        cmd = d[0]
+        synth = 'B' if cmd & 0x08 else 'A'
+        if cmd == 0x81:
+            return frame(struct.pack('>i', self.reference))
+        if cmd & 0xf7 == 0x80:
+            return frame(self.regs[synth])
+        if cmd & 0xf7 == 0x83:
+            return frame(struct.pack('>hh', 2200, 4400))
+        if cmd & 0xf7 == 0x86:
+            return frame([0x30 | self.refsel])
+        if cmd & 0xf7 == 0x00 and len(d) == 26:
+            self.regs[synth] = bytes(d[1:25])
+            return ACK
+        if cmd == 0x06:
+            self.refsel = d[1]
+            return ACK
+        if cmd == 0x40:
+            self.flashes += 1
+            return ACK
+        return NACK
+
+def open_v500x(dev, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    return V500X(MemoryTransport(dev), **kwargs)
+
+def test_short_read_retried():
+    dev = FakeV500X()
+    dev.replies = [b'\x00\x98']
+    synth = open_v500x(dev)
+    assert synth.GetReference() == 10000000
+    assert dev.commands == [b'\x81', b'\x81']
+
+def test_checksum_error():
+    dev = FakeV500X()
+    bad = frame(struct.pack('>i', 10000000))[:-1] + b'\x00'
+    dev.replies = [bad] * 4
+    synth = open_v500x(dev, retries=3)
+    with pytest.raises(ValonChecksumError):
+        synth.GetReference()
+    # the first try and 3 retries
+    assert len(dev.commands) == 4
+
+def test_checksum_error_recovered():
+    dev = FakeV500X()
+    dev.replies = [b'\x00\x98\x96\x80\x00']
+    synth = open_v500x(dev)
+    assert synth.GetReference() == 10000000
+
+def test_nack():
+    dev = FakeV500X()
+    dev.replies = [NACK]
+    synth = open_v500x(dev)
+    with pytest.raises(ValonNack):
+        synth.SetRefSelect('external')
+    # commands are never retried
+    assert len(dev.commands) == 1
+
+def test_no_ack():
+    dev = FakeV500X()
+    dev.replies = [b'']
+    synth = open_v500x(dev)
+    with pytest.raises(ValonTimeout):
+        synth.Flash()
+    assert dev.flashes == 0
+
+def test_unexpected_reply():
+    dev = FakeV500X()
+    dev.replies = [b'\x42\x42']
+    synth = open_v500x(dev)
+    with pytest.raises(ValonError):
+        synth.SetRefSelect('external')
+    # the rest of the garbage is dropped
+    assert synth.ser.in_waiting == 0
+    assert synth.SetRefSelect('external') == True
+
+def test_stale_bytes_dropped():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    # e.g. the late reply of a timed out transaction
+    synth.ser.buf = b'\x06\x00\x98'
+    assert synth.GetReference() == 10000000
+    synth.ser.buf = b'\x15'
+    assert synth.SetRefSelect('external') == True
+    assert dev.commands == [b'\x81', b'\x06\x01\x07']
+
+class GlitchyPort(object):
+    """
+    pyserial port failing like a USB hub glitch, until opened again.
+    """
+    def __init__(self, dev):
+        self.dev = dev
+        self.failed = False
+        self.opens = 0
+        self.buf = b''
+
+    @property
+    def in_waiting(self):
+        return len(self.buf)
+
+    def fail(self):
+        self.failed = True
+
+    def write(self, d):
+        if self.failed:
+            # pyserial's SerialException is an OSError
+            raise OSError('device reports readiness to read but returned no data')
+        self.buf += self.dev(bytes(d))
+        return len(d)
+
+    def read(self, n):
+        if self.failed:
+            raise OSError('device reports readiness to read but returned no data')
+        d = self.buf[:n]
+        self.buf = self.buf[n:]
+        return d
+
+    def reset_input_buffer(self):
+        self.buf = b''
+
+    def close(self):
+        pass
+
+    def open(self):
+        self.opens += 1
+        self.failed = False
+
+def test_serial_failure_retried():
+    dev = FakeV500X()
+    # the port as opened by SerialTransport, without a real device
+    t = SerialTransport.__new__(SerialTransport)
+    Transport.__init__(t, '/dev/ttyUSB0', 0.5)
+    t.ser = GlitchyPort(dev)
+    t.broken = False
+    synth = V500X(t, backoff=0)
+    assert synth.GetReference() == 10000000
+    t.ser.fail()
+    # the port is opened again, and the read retried
+    assert synth.GetReference() == 10000000
+    assert t.ser.opens == 1
+    t.ser.fail()
+    with pytest.raises(ValonTimeout):
+        t.read(1)
+
+def test_state_cache_reused(tmp_path):
+    dev = FakeV500X()
+    synth = open_v500x(dev, cache=str(tmp_path))
+    synth.SetRFLevel('A', 5)
+    synth.SetRFLevel('B', 5)
+    synth.close()
+    dev.commands = []
+    synth = open_v500x(dev, cache=str(tmp_path))
+    # one read per cached block, then no read before the write
+    assert dev.commands == [b'\x80', b'\x88']
+    synth.SetRFLevel('B', 2)
+    assert len(dev.commands) == 3
+    assert synth.GetRFLevel('B') == 2
+
+def test_state_cache_stale_block(tmp_path):
+    dev = FakeV500X()
+    synth = open_v500x(dev, cache=str(tmp_path))
+    synth.SetRFLevel('A', 5)
+    synth.SetFreq('B', 1000)
+    synth.close()
+    # B is changed without the cache, e.g. by --nocache or a ValonFleet worker
+    other = open_v500x(dev)
+    other.SetFreq('B', 3000)
+    other.close()
+    b = dev.regs['B']
+    synth = open_v500x(dev, cache=str(tmp_path))
+    assert synth.LoadState(synth._state_path(str(tmp_path))) == False
+    synth.SetRFLevel('B', 2)
+    # the frequency set by the other run is kept
+    assert synth._unpack_freq_registers(dev.regs['B']) == synth._unpack_freq_registers(b)
+    assert synth.GetRFLevel('B') == 2
+
+@pytest.mark.parametrize('content', [
+    '[1, 2]',
+    '{"version": 1, "device": "loop://", "regs": {"A": "zz"}}',
+    '{"version": 1, "device": "loop://", "regs": {"A": "00"}}',
+    '{"version": 1, "device": "loop://", "regs": {"C": "%s"}}'%('00' * 24),
+    '{"version": 1, "device": "loop://", "regs": ["A"]}',
+    '{"version": 1, "device": "loop://", "regs": {"A": "%s"}, "vcor": {"A": 1}}'%('00' * 24),
+    '{"version": 1, "device": "loop://", "regs": {"A": "%s"}, "flashed": []}'%('00' * 24),
+    '{"version": 1, "device": "loop://", "regs": {"A": "%s"}, "refsel": 3}'%('00' * 24),
+])
+def test_state_cache_bad_contents(tmp_path, content):
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    path = synth._state_path(str(tmp_path))
+    with open(path, 'w') as f:
+        f.write(content)
+    # a cache miss, so the device is opened cold
+    synth = open_v500x(dev, cache=str(tmp_path))
+    assert synth.LoadState(path) == False
+    assert synth.shadow['vcor'] == {}
+    assert synth.GetReference() == 10000000
+
+def test_unknown_flash_is_dirty():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    # nothing written yet, but the flash content is unknown
+    assert synth.IsDirty() == True
+    assert synth.Commit() == True
+    assert dev.flashes == 1
+
+def test_commit_once():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    synth.SetRFLevel('A', 5)
+    assert synth.Commit() == True
+    assert synth.IsDirty() == False
+    assert synth.Commit() == False
+    assert dev.flashes == 1
+
+def test_written_back_is_clean():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    synth.SetRFLevel('A', 5)
+    synth.SetRefSelect('internal')
+    synth.Commit()
+    synth.SetRFLevel('A', 2)
+    synth.SetRefSelect('external')
+    assert synth.IsDirty() == True
+    synth.SetRFLevel('A', 5)
+    assert synth.IsDirty() == True
+    synth.SetRefSelect('internal')
+    assert synth.IsDirty() == False
+    assert synth.Commit() == False
+    assert dev.flashes == 1
+
+def test_failed_write_is_dirty():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    synth.SetRFLevel('A', 5)
+    synth.Commit()
+    dev.replies = [b'']
+    with pytest.raises(ValonTimeout):
+        synth.SetRFLevel('A', 2)
+    # the device may have taken it
+    assert synth.IsDirty() == True
+
+def test_auto_commit_coalesced():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    synth.AutoCommit(0.1)
+    for level in (-4, -1, 2, 5):
+        synth.SetRFLevel('A', level)
+        synth.SetRFLevel('B', level)
+    assert dev.flashes == 0
+    t_end = time.time() + 2
+    while dev.flashes == 0 and time.time() < t_end:
+        time.sleep(0.01)
+    time.sleep(0.2)
+    assert dev.flashes == 1
+    assert synth.IsDirty() == False
+    synth.close()
+    assert dev.flashes == 1
+
+def test_auto_commit_flushed_on_close():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    synth.AutoCommit(60)
+    synth.SetRFLevel('A', 5)
+    synth.close()
+    assert dev.flashes == 1
+    assert synth.commit_timer is None
+
+def test_flashed_state_cached(tmp_path):
+    dev = FakeV500X()
+    synth = open_v500x(dev, cache=str(tmp_path))
+    synth.SetRFLevel('A', 5)
+    synth.SetRefSelect('external')
+    synth.Commit()
+    synth.close()
+    synth = open_v500x(dev, cache=str(tmp_path))
+    assert synth.flashed['known'] == True
+    assert synth.IsDirty() == False
+    assert synth.Commit() == False
+    synth.SetRFLevel('A', 2)
+    synth.close()
+    # written but not flashed, still dirty in the next run
+    synth = open_v500x(dev, cache=str(tmp_path))
+    assert synth.IsDirty() == True
+    assert synth.Commit() == True
+    assert dev.flashes == 2
+
+def test_dwell():
+    table = SettleTable('loop://', 'A', [1000, 1500, 2000], [0.5, 0.002, 0.001])
+    assert table.Dwell(1750) == 0.002
+    assert table.Dwell(1200) == 0.5
+    # never measured, so the worst case
+    assert table.Dwell(2500) == 0.5
+    assert table.Dwell(500) == 0.5
+    table = SettleTable('loop://', 'A', [1000, 1500, 2000], [None, None, 0.001])
+    assert table.Dwell(1200) == 0.001
+    table = SettleTable('loop://', 'A', [1000, 1500], [None, None])
+    assert table.Dwell(1200) == 0.0
+
+def test_characterize_settle():
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    table = synth.CharacterizeSettle('A', [1000, 1500, 2000], samples=2)
+    assert table.freqs == [1000, 1500, 2000]
+    assert all([x is not None and x >= 0 for x in table.settle])
+    with pytest.raises(ValueError):
+        synth.CharacterizeSettle('A', [1000, 1000])
+    with pytest.raises(ValueError):
+        synth.CharacterizeSettle('A', [1000, 1500], samples=0)
+
+def test_characterize_cli_range(capsys):
+    dev = FakeV500X()
+    synth = open_v500x(dev)
+    for argv in (['--characterize', '1000', '1000', '10'],
+                 ['--characterize', '1000', '2000', '0'],
+                 ['--characterize', '1000', '1005', '10'],
+                 ['--characterize', '1000', '2000', '500', '--samples', '0']):
+        v5008.Run(synth, v5008.BuildParser().parse_args(['--synth', 'A'] + argv))
+        assert '--' in capsys.readouterr().out
+    # nothing measured
+    assert dev.commands == []
@@ -0,0 +1,147 @@
+import pytest
+
+from Valon import V5015, PROMPT
+from ValonTransport import MemoryTransport
+
+class FakeV5015(object):
+    """
+    In-memory V5015: echoes each command, then replies with the setting and
+    the prompt, like the device does.
+    """
+    def __init__(self):
+        self.state = {'F': '1000', 'PWR': '0', 'OEN': '1', 'PDN': '1'}
+        self.commands = []
+        # number of commands in each write
+        self.bursts = []
+        # indices of the commands whose reply is cut before the prompt
+        self.cut = set()
+        # stop replying after this many commands
+        self.quiet = None
+        # the unit of the actual frequency, None for no 'Act' field
+        self.act = 'MHz'
+        # the actual frequency is off by this much in MHz
+        self.offset = 0.0
+
+    def __call__(self, d):
+        r = ''
+        lines = [x for x in d.decode().split('\r') if x != '']
+        self.bursts.append(len(lines))
+        for line in lines:
+            i = len(self.commands)
+            self.commands.append(line)
+            if self.quiet is None or i < self.quiet:
+                r += self.reply(line, i)
+        return r.encode()
+
+    def actual(self, v):
+        if self.act is None:
+            return ''
+        f = float(v) + self.offset
+        if self.act == 'GHz':
+            return '; // Act %g GHz'%(f / 1000)
+        if self.act == 'Hz':
+            return '; // Act %d Hz'%round(f * 1e6)
+        return '; // Act %g MHz'%f
+
+    def reply(self, line, i):
+        t = line.split(' ')
+        if len(t) > 1:
+            self.state[t[0]] = {'ON': '1', 'OFF': '0'}.get(t[1], t[1])
+        v = self.state[t[0]]
+        if t[0] == 'F':
+            r = 'F %s MHz%s\r\n'%(v, self.actual(v))
+        elif t[0] == 'PWR':
+            r = 'PWR %s; // %s dBm\r\n'%(v, v)
+        else:
+            r = '%s %s;\r\n'%(t[0], v)
+        r = line + '\r\n' + r
+        if i in self.cut:
+            return r
+        return r + PROMPT
+
+def open_v5015(dev):
+    return V5015(MemoryTransport(dev), 9600)
+
+def test_splitreplies():
+    synth = open_v5015(FakeV5015())
+    assert synth._splitreplies(b'F\r\n-->PWR\r\n-->') == ['F\r\n-->', 'PWR\r\n-->']
+    # the trailing data is an incomplete reply
+    assert synth._splitreplies(b'F\r\n-->PWR\r\n') == ['F\r\n-->']
+    assert synth._splitreplies(b'') == []
+
+def test_apply_burst():
+    dev = FakeV5015()
+    synth = open_v5015(dev)
+    r = synth.Apply(freq=2000, amp=4, rfout='off', pwr='status')
+    assert r == {'freq': '2000MHz', 'amp': '4dBm', 'rfout': 'OFF', 'pwr': 'ON'}
+    assert dev.commands == ['F 2000 MHz', 'PWR 4', 'OEN OFF', 'PDN']
+    # all the commands went out in one write
+    assert synth.ser.Stats()['writes'] == 1
+
+def test_apply_missing_last_reply():
+    dev = FakeV5015()
+    dev.cut = set([2])
+    synth = open_v5015(dev)
+    r = synth.Apply(freq=2000, amp=4, rfout='off')
+    assert r == {'freq': '2000MHz', 'amp': '4dBm', 'rfout': None}
+    # the partial reply isn't left for the next command
+    assert synth.ser.in_waiting == 0
+    assert synth.Apply(rfout='status') == {'rfout': 'OFF'}
+
+def test_sweep():
+    dev = FakeV5015()
+    synth = open_v5015(dev)
+    freqs = [1000 + i * 0.5 for i in range(10)]
+    r = synth.Sweep(freqs, window=3)
+    assert r['achieved'] == freqs
+    assert r['errors'] == []
+    assert r['points'] == 10
+    assert dev.commands == ['F %s MHz'%f for f in freqs]
+    assert max(dev.bursts) <= 3
+
+@pytest.mark.parametrize('act', ['GHz', 'Hz'])
+def test_sweep_units(act):
+    dev = FakeV5015()
+    dev.act = act
+    synth = open_v5015(dev)
+    freqs = [1000, 1500.25, 2000]
+    r = synth.Sweep(freqs)
+    assert r['achieved'] == pytest.approx(freqs)
+    assert r['errors'] == []
+
+def test_sweep_not_verified():
+    dev = FakeV5015()
+    dev.act = None
+    synth = open_v5015(dev)
+    # the echoed request doesn't tell what the device has set
+    r = synth.Sweep([1000, 1500])
+    assert r['achieved'] == [None, None]
+    assert r['errors'] == [0, 1]
+    assert r['points'] == 0
+
+def test_sweep_out_of_tol():
+    dev = FakeV5015()
+    dev.offset = 0.01
+    synth = open_v5015(dev)
+    r = synth.Sweep([1000, 1500], tol=0.001)
+    assert r['errors'] == [0, 1]
+    r = synth.Sweep([1000, 1500], tol=0.1)
+    assert r['errors'] == []
+
+def test_sweep_quiet_device():
+    dev = FakeV5015()
+    dev.quiet = 5
+    synth = open_v5015(dev)
+    freqs = [1000 + i for i in range(10)]
+    r = synth.Sweep(freqs, window=4)
+    assert r['achieved'] == freqs[:5] + [None] * 5
+    assert r['errors'] == [5, 6, 7, 8, 9]
+    assert r['points'] == 5
+    # no more commands than the window past the last reply
+    assert len(dev.commands) <= 5 + 4
+    assert synth.ser.in_waiting == 0
+
+def test_sweep_window():
+    synth = open_v5015(FakeV5015())
+    with pytest.raises(ValueError):
+        synth.Sweep([1000, 1500], window=0)
@@ -15,7 +15,6 @@ optional arguments:
   --pwr PWR      The power status('on' or 'off' or 'status')
   --v            Verbose
 """
-from Valon import V500X
 from argparse import ArgumentParser
 
 JUST_LEN = 12
@@ -40,7 +39,19 @@ def GetSynth(args):
     else:
         return args.synth
 
-def main():
+def Try(msg, func, *args):
+    """
+    Run func, and print msg with the reason if the device reports an error.
+    """
+    # Valon is already imported once a device is open
+    from Valon import ValonError
+    try:
+        return func(*args)
+    except ValonError as e:
+        print('%s: %s'%(msg, e))
+        return False
+
+def BuildParser():
     parser = ArgumentParser(description="Usage for Setting V5008.")
     parser.add_argument('--dev',dest='dev', type=str, default='/dev/ttyUSB0',help='Serial port for V5008.')
     parser.add_argument('--baud',dest='baud', type=int, default=9600, help='Baud rate.')
@@ -49,55 +60,94 @@ def main():
     parser.add_argument('--amp', dest='amp', type=int, choices=[-4, -1, 2, 5], default=-999, help='The amplitude level.')
     parser.add_argument('--ref',dest='ref',type=str, choices=['external', 'internal'], default='', help='The reference source(\'internal\' or \'external\')')
     parser.add_argument('--status', dest='status', default=False, action='store_true', help='Check the synthesizer status')
-    parser.add_argument('--flash', dest='flash', default=False, action='store_true', help='Write the parameters into flash')
-    args = parser.parse_args()
-    
-    print('%s: %s'%('Dev'.ljust(JUST_LEN),args.dev))
-    print('%s: %s'%('Baud'.ljust(JUST_LEN),args.baud))
+    parser.add_argument('--flash', dest='flash', default=False, action='store_true', help='Write the parameters into flash, if they have been changed')
+    parser.add_argument('--characterize', dest='characterize', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'), default=None, help='Measure the settle time from START to STOP MHz')
+    parser.add_argument('--samples', dest='samples', type=int, default=3, help='Number of samples at each frequency for --characterize')
+    parser.add_argument('--nocache', dest='cache', default=True, action='store_false', help='Don\'t use the state cache')
+    return parser
+
+def HasWork(args):
+    return bool(args.freq or args.amp != -999 or args.ref != '' or args.status or args.flash or args.characterize)
+
+def ApplyFreq(synth, s, freq):
+    synth.SetFreq(s, freq)
+    freq = synth.GetFreq(s)
+    print('%s: %s'%('synthesizer'.ljust(JUST_LEN), s))
+    print('%s: %.02f'%('Freq(MHz)'.ljust(JUST_LEN), freq))
+
+def ApplyAmp(synth, s, amp):
+    synth.SetRFLevel(s, amp)
+    rf_level = synth.GetRFLevel(s)
+    print('%s: %s'%('synthesizer'.ljust(JUST_LEN), s))
+    print('%s: %d'%('RF Level'.ljust(JUST_LEN), rf_level))
 
-    synth = V500X(args.dev, args.baud)    
+def ApplyRef(synth, sel):
+    synth.SetRefSelect(sel)
+    ref = synth.GetRefSelect()
+    print('%s: %s'%('Reference'.ljust(JUST_LEN), ref))
+
+def Run(synth, args):
+    # the options for one synthesizer need --synth
+    if args.freq or args.amp != -999 or args.characterize:
+        s = GetSynth(args)
+        if s is None:
+            return
     # set freq
     if args.freq :
-        s = GetSynth(args)
-        r = synth.SetFreq(s, args.freq)
-        if r == False:
-            print('Frequency set faild.')
-        else:
-            freq = synth.GetFreq(s)
-            print('%s: %s'%('synthesizer'.ljust(JUST_LEN), s))
-            print('%s: %.02f'%('Freq(MHz)'.ljust(JUST_LEN), freq))
+        Try('Frequency set faild', ApplyFreq, synth, s, args.freq)
     # set RF level
     if args.amp != -999:
-        s = GetSynth(args)
-        r = synth.SetRFLevel(s, args.amp)
-        if r == False:
-            print('Amp set faild.')
-        else:
-            rf_level = synth.GetRFLevel(s)
-            print('%s: %s'%('synthesizer'.ljust(JUST_LEN), s))
-            print('%s: %d'%('RF Level'.ljust(JUST_LEN), rf_level))
+        Try('Amp set faild', ApplyAmp, synth, s, args.amp)
     # set ref
     if args.ref != '':
-            r = synth.SetRefSelect(args.ref)
-            if r == False:
-                print('Reference set faild.')
-            else:
-                ref = synth.GetRefSelect()
-                print('%s: %s'%('Reference'.ljust(JUST_LEN), ref))
+        Try('Reference set faild', ApplyRef, synth, args.ref)
     if args.status:
         print('')
-        CheckStatus(synth, 'A')
+        Try('Status check faild', CheckStatus, synth, 'A')
         print('')
-        CheckStatus(synth, 'B')
+        Try('Status check faild', CheckStatus, synth, 'B')
+    if args.characterize:
+        start, stop, step = args.characterize
+        if step <= 0 or stop <= start:
+            print('--characterize needs START < STOP and STEP > 0.')
+            return
+        n = int(round((stop - start) / step)) + 1
+        if n < 2:
+            print('--characterize needs STEP <= STOP - START, to measure at least 2 frequencies.')
+            return
+        if args.samples < 1:
+            print('--samples needs at least 1 sample at each frequency.')
+            return
+        freqs = [start + i * step for i in range(n)]
+        table = Try('Characterization faild', synth.CharacterizeSettle, s, freqs, args.samples)
+        if table != False:
+            print('%s: %s'%('synthesizer'.ljust(JUST_LEN), s))
+            for i in range(len(table.freqs)):
+                if table.settle[i] is None:
+                    print('%s: %s'%(('%.03f MHz'%table.freqs[i]).ljust(JUST_LEN), 'Unlocked'))
+                else:
+                    print('%s: %.03f ms'%(('%.03f MHz'%table.freqs[i]).ljust(JUST_LEN), table.settle[i] * 1000))
+            print('%s: %s'%('Saved to'.ljust(JUST_LEN), table.Save()))
     if args.flash:
-        if args.status == False:
-            print('')
-            CheckStatus(synth, 'A')
-            print('')
-            CheckStatus(synth, 'B')
-        synth.Flash()
+        # only flash when something has changed since the last flash
+        r = Try('Flash faild', synth.Commit)
         print('')
-        print('The parameters have been written into flash!')
+        if r == True:
+            print('The parameters have been written into flash!')
+        elif r == False and not synth.IsDirty():
+            print('Nothing changed since the last flash.')
+
+def main():
+    args = BuildParser().parse_args()
+    # nothing to do, so don't open the device at all
+    if not HasWork(args):
+        return
+    # Valon (and pyserial) is only imported when a device is used
+    from Valon import V500X
+    print('%s: %s'%('Dev'.ljust(JUST_LEN),args.dev))
+    print('%s: %s'%('Baud'.ljust(JUST_LEN),args.baud))
+    synth = V500X(args.dev, args.baud, cache=args.cache)
+    Run(synth, args)
     synth.close()
 
 if __name__=='__main__':
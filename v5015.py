@@ -15,12 +15,11 @@ optional arguments:
   --pwr PWR      The power status('on' or 'off' or 'status')
   --v            Verbose
 """
-from Valon import V5015
 from argparse import ArgumentParser
 
 JUST_LEN = 8
 
-def main():
+def BuildParser():
     parser = ArgumentParser(description="Usage for Setting V5015.")
     parser.add_argument('--dev',dest='dev', type=str, default='/dev/ttyUSB0',help='Serial port for V5015.')
     parser.add_argument('--baud',dest='baud', type=int, default=9600, help='Baud rate.')
@@ -30,35 +29,41 @@ def main():
     parser.add_argument('--rfout', dest='rfout', type=str, default='', help='The rfout status(\'on\' or \'off\'  or \'status\')')
     parser.add_argument('--pwr', dest='pwr', type=str, default='', help='The power status(\'on\' or \'off\'  or \'status\')')
     parser.add_argument('--v', dest='verbose', default=False, action='store_true', help='Verbose')
-    args = parser.parse_args()
-    
+    return parser
+
+def HasWork(args):
+    return bool(args.freq or args.amp > -999 or args.ref or args.rfout or args.pwr)
+
+def Run(synth, args):
+    # all the settings go out in one burst, and come back in one read
+    r = synth.Apply(freq=args.freq if args.freq else None,
+                    amp=args.amp if args.amp > -999 else None,
+                    ref=args.ref if args.ref else None,
+                    rfout=args.rfout if args.rfout else None,
+                    pwr=args.pwr if args.pwr else None,
+                    verbose=args.verbose)
+    if 'freq' in r:
+        print('%s: %s'%('Freq'.ljust(JUST_LEN),r['freq']))
+    if 'amp' in r:
+        print('%s: %s'%('Freq'.ljust(JUST_LEN),r['amp']))
+    if 'ref' in r:
+        print('%s: %s'%('Ref'.ljust(JUST_LEN),r['ref']))
+    if 'rfout' in r:
+        print('%s: %s'%('Rfout'.ljust(JUST_LEN),r['rfout']))
+    if 'pwr' in r:
+        print('%s: %s'%('Pwr'.ljust(JUST_LEN),r['pwr']))
+
+def main():
+    args = BuildParser().parse_args()
+    # nothing to do, so don't open the device at all
+    if not HasWork(args):
+        return
+    # Valon (and pyserial) is only imported when a device is used
+    from Valon import V5015
     print('%s: %s'%('Dev'.ljust(JUST_LEN),args.dev))
     print('%s: %s'%('Baud'.ljust(JUST_LEN),args.baud))
     synth = V5015(args.dev, args.baud)
-    if args.freq :
-        r = synth.SetFreq(args.freq,'MHz',verbose=args.verbose)
-        print('%s: %s'%('Freq'.ljust(JUST_LEN),r))
-    if args.amp > -999:
-        r = synth.SetAmp(args.amp,verbose=args.verbose)
-        print('%s: %s'%('Freq'.ljust(JUST_LEN),r))
-    if args.ref:
-        if args.ref == 'status':
-            r = synth.SetRef(verbose=args.verbose)
-        else:
-            r = synth.SetRef(args.ref,verbose=args.verbose)
-        print('%s: %s'%('Ref'.ljust(JUST_LEN),r))
-    if args.rfout:
-        if args.rfout == 'status':
-            r = synth.RFout(verbose=args.verbose)
-        else:
-            r = synth.RFout(args.rfout,verbose=args.verbose)
-        print('%s: %s'%('Rfout'.ljust(JUST_LEN),r))
-    if args.pwr:
-        if args.pwr == 'status':
-            r = synth.PWRout(verbose=args.verbose)
-        else:
-            r = synth.PWRout(args.pwr,verbose=args.verbose)
-        print('%s: %s'%('Pwr'.ljust(JUST_LEN),r))
+    Run(synth, args)
     synth.close()
 
 if __name__=='__main__':